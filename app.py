@@ -1,20 +1,178 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
-import yt_dlp
-import io
-import requests
-import xml.etree.ElementTree as ET
+import threading
+import queue
+from requests_cache import CachedSession, DO_NOT_CACHE
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree
 import html
+from charset_normalizer import from_bytes
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- ページ設定 ---
 st.set_page_config(page_title="動画選出集計ツール", layout="wide")
 
 # --- 定数・正規表現 ---
-NICO_ID_RE = re.compile(r'(sm\d+|so\d+|nm\d+)')
+# 接頭辞をまとめて、数字部分の照合を1回で済ませる
+NICO_ID_RE = re.compile(r'((?:sm|so|nm)\d+)')
+NICO_ID_PREFIXES = frozenset(('sm', 'so', 'nm'))
 YT_ID_RE = re.compile(r'(?:v=|\/v\/|embed\/|youtu\.be\/|\/shorts\/)([a-zA-Z0-9_-]{11})')
+URL_RE = re.compile(r'https?://[^\s<>"]+')
+MYLIST_RE = re.compile(r'/mylist/(\d+)')
+SERIES_RE = re.compile(r'/series/(\d+)')
+
+# ニコニコ動画 nvapi(JSON) 用の設定
+NVAPI_HEADERS = {'X-Frontend-Id': '6', 'X-Frontend-Version': '0'}
+NVAPI_PAGE_SIZE = 100
+
+# getthumbinfo のレスポンスから使う要素
+THUMB_FIELDS_XPATH = etree.XPath(
+    'thumb/*[self::title or self::user_nickname or self::first_retrieve or self::length]'
+)
+
+# 動画情報を同時に取得するスレッド数
+MAX_FETCH_WORKERS = 16
+# マイリスト等の中身をまとめて問い合わせる際のスレッド数
+NICO_BATCH_WORKERS = 8
+# 全スレッドが同時に通信しても接続を捨てずに済むよう、プールの大きさをスレッド数に合わせる
+HTTP_POOL_SIZE = MAX_FETCH_WORKERS * NICO_BATCH_WORKERS
+# 取得した動画情報をセッションをまたいで保持する期間（秒）と件数
+METADATA_CACHE_TTL = 24 * 3600
+METADATA_CACHE_MAX_ENTRIES = 10000
+
+# yt-dlp の設定（インスタンスは使い終わったらプールに戻して使い回す）
+YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': True,
+    'skip_download': True,
+}
+# ニコニコ動画へのリクエスト上限（回/秒、全スレッド合計）
+NICO_REQUESTS_PER_SECOND = 20
+
+# プログレスバーを更新する最大回数
+PROGRESS_UPDATES = 50
+
+class RateLimiter:
+    """複数スレッドで共有し、リクエストの間隔を一定以上に保つ"""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """自分の順番が来るまで待つ"""
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+        time.sleep(delay)
+
+@st.cache_resource
+def get_nico_rate_limiter():
+    """ニコニコ動画へのリクエスト間隔を管理する RateLimiter を返す（全ユーザーで共有）"""
+    return RateLimiter(NICO_REQUESTS_PER_SECOND)
+
+class RateLimitedAdapter(HTTPAdapter):
+    """実際に通信する時だけ RateLimiter で間隔を空ける HTTPAdapter（キャッシュから返す分は待たない）"""
+
+    def __init__(self, rate_limiter, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.rate_limiter.wait()
+        return super().send(request, **kwargs)
+
+@st.cache_resource
+def get_session():
+    """HTTP通信用のセッションを返す（再実行やユーザーをまたいで接続を使い回す）"""
+    # 動画単体の情報はディスクにも保存し、再起動後の再実行でも通信せずに済ませる
+    # （マイリスト・シリーズの中身は変わりうるため保存しない）
+    session = CachedSession(
+        '.cache/nico',
+        backend='sqlite',
+        urls_expire_after={
+            'ext.nicovideo.jp/api/getthumbinfo': timedelta(days=7),
+            '*': DO_NOT_CACHE,
+        },
+        # getthumbinfo は取得失敗も HTTP 200 で返すため、status="ok" の応答だけを保存する
+        filter_fn=lambda response: b'status="ok"' in response.content
+    )
+    # このセッションの通信先はニコニコ動画だけなので、すべて共通の間隔制限にかける
+    session.mount("https://", RateLimitedAdapter(
+        get_nico_rate_limiter(),
+        pool_connections=4,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(total=2, backoff_factor=0.2)
+    ))
+    return session
+
+# Streamlit は操作のたびにスクリプト全体を再実行するため、
+# セッション（とその中のリクエスト間隔の管理）は st.cache_resource で1つに保つ
+SESSION = get_session()
+
+class MetadataCache:
+    """取得できた動画情報を期限付きで保持する（複数スレッドで共有）"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """期限内の情報があれば返す（なければ None）"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[1]
+
+    def put(self, key, value):
+        """情報を保存する（上限を超えたら古いものから捨てる）"""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+
+    def clear(self):
+        """保持している情報をすべて捨てる"""
+        with self.lock:
+            self.entries.clear()
+
+@st.cache_resource
+def get_ytdlp_video_cache():
+    """yt-dlp で取得できた単体動画の情報を置いておくキャッシュを返す（全ユーザーで共有）"""
+    return MetadataCache(METADATA_CACHE_TTL, METADATA_CACHE_MAX_ENTRIES)
+
+# 再生リストは中身が変わりうるため、単体動画の結果だけをここに保存する
+YTDLP_VIDEO_CACHE = get_ytdlp_video_cache()
+
+@st.cache_resource
+def get_ydl_pool():
+    """使い終わった YoutubeDL を置いておくプールを返す（再実行やスレッドをまたいで共有）"""
+    return queue.SimpleQueue()
+
+YDL_POOL = get_ydl_pool()
+
+def take_ydl():
+    """プールから YoutubeDL を1つ取り出す（空なら新しく作る）。使い終わったら YDL_POOL に戻すこと"""
+    try:
+        return YDL_POOL.get_nowait()
+    except queue.Empty:
+        # yt-dlp は読み込みが重いため、ニコニコ動画以外のURLが来た時に初めて import する
+        import yt_dlp
+        return yt_dlp.YoutubeDL(YDL_OPTS)
 
 def format_duration(seconds):
     """秒数を 分:秒 形式に変換"""
@@ -28,36 +186,115 @@ def format_duration(seconds):
     except:
         return "[不明]"
 
-def get_nico_metadata_api(video_id):
-    """ニコニコ動画の公式外部API(getthumbinfo)から情報を取得する"""
+def format_nico_date(raw_date):
+    """ニコニコのISO形式の日時を 年-月-日 時:分:秒 形式に変換"""
+    # "YYYY-MM-DDTHH:MM:SS+09:00" 形式なら解析せずに切り出すだけで済む
+    if len(raw_date) >= 19 and raw_date[10] == 'T' and raw_date[4] == '-' and raw_date[13] == ':':
+        return f"{raw_date[:10]} {raw_date[11:19]}"
+    dt = datetime.fromisoformat(raw_date)
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+@st.cache_data(ttl=METADATA_CACHE_TTL, max_entries=METADATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def fetch_nico_metadata(video_id):
+    """getthumbinfo から動画情報を取得する（取得できなければ例外を送出し、成功した結果だけがキャッシュされる）"""
     api_url = f"https://ext.nicovideo.jp/api/getthumbinfo/{video_id}"
+    response = SESSION.get(api_url, timeout=5)
+    if response.status_code != 200:
+        raise ValueError(f"getthumbinfo returned HTTP {response.status_code}")
+    root = etree.fromstring(response.content)
+    if root.get('status') != 'ok':
+        raise ValueError(f"getthumbinfo returned status {root.get('status')}")
+
+    # 必要な要素だけをコンパイル済みのXPathで1回で取り出す
+    fields = {element.tag: element.text for element in THUMB_FIELDS_XPATH(root)}
+    upload_date = format_nico_date(fields['first_retrieve'])
+    
+    # ニコニコの時間は "MM:SS" 形式で返ってくる
+    length_str = fields['length'] if 'length' in fields else "[不明]"
+    
+    return {
+        'video_id': video_id,
+        'title': fields['title'],
+        'uploader': fields['user_nickname'] if 'user_nickname' in fields else "公式/不明",
+        'upload_date': upload_date,
+        'duration': length_str,
+        'url': f"https://www.nicovideo.jp/watch/{video_id}"
+    }
+
+def get_nico_metadata_api(video_id):
+    """ニコニコ動画の公式外部API(getthumbinfo)から情報を取得する（失敗時は None。失敗は次回また取り直す）"""
     try:
-        response = requests.get(api_url, timeout=5)
-        if response.status_code == 200:
-            root = ET.fromstring(response.text)
-            if root.get('status') == 'ok':
-                thumb = root.find('thumb')
-                raw_date = thumb.find('first_retrieve').text
-                dt = datetime.fromisoformat(raw_date)
-                
-                # ニコニコの時間は "MM:SS" 形式で返ってくる
-                length_str = thumb.find('length').text if thumb.find('length') is not None else "[不明]"
-                
-                return {
-                    'video_id': video_id,
-                    'title': thumb.find('title').text,
-                    'uploader': thumb.find('user_nickname').text if thumb.find('user_nickname') is not None else "公式/不明",
-                    'upload_date': dt.strftime('%Y-%m-%d %H:%M:%S'),
-                    'duration': length_str,
-                    'url': f"https://www.nicovideo.jp/watch/{video_id}"
-                }
+        return fetch_nico_metadata(video_id)
+    except Exception:
+        return None
+
+def get_nico_metadata_batch(video_ids):
+    """複数のニコニコ動画IDの情報を並列で取得する（ID→情報 の辞書を返す）"""
+    unique_ids = list(dict.fromkeys(video_ids))
+    if not unique_ids:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(NICO_BATCH_WORKERS, len(unique_ids))) as executor:
+        return dict(zip(unique_ids, executor.map(get_nico_metadata_api, unique_ids)))
+
+def fetch_nvapi_items(api_url, get_items):
+    """nvapiのページ送りをたどって一覧の項目をすべて取得する"""
+    items = []
+    page = 1
+    while True:
+        response = SESSION.get(
+            api_url,
+            params={'page': page, 'pageSize': NVAPI_PAGE_SIZE},
+            headers=NVAPI_HEADERS,
+            timeout=10
+        )
+        if response.status_code != 200:
+            return None
+        page_items = get_items(response.json()['data'])
+        items.extend(page_items)
+        if len(page_items) < NVAPI_PAGE_SIZE:
+            return items
+        page += 1
+
+def nvapi_video_to_metadata(video, comment=""):
+    """nvapiの動画情報を集計用の形式に変換する"""
+    video_id = video['id']
+    owner = video.get('owner') or {}
+    registered_at = video.get('registeredAt')
+    return {
+        'video_id': video_id,
+        'title': video.get('title') or "[タイトル取得不可]",
+        'uploader': owner.get('name') or "公式/不明",
+        'upload_date': format_nico_date(registered_at) if registered_at else "[不明]",
+        'duration': format_duration(video.get('duration')),
+        'mylist_comment': comment,
+        'url': f"https://www.nicovideo.jp/watch/{video_id}"
+    }
+
+def get_nico_mylist_nvapi(mylist_id):
+    """ニコニコ動画のマイリストをnvapiから取得する（マイリストコメントも同時に取れる）"""
+    api_url = f"https://nvapi.nicovideo.jp/v2/mylists/{mylist_id}"
+    try:
+        items = fetch_nvapi_items(api_url, lambda data: data['mylist']['items'])
+        if items is not None:
+            return [nvapi_video_to_metadata(item['video'], item.get('description') or "") for item in items]
+    except Exception:
+        pass
+    return None
+
+def get_nico_series_nvapi(series_id):
+    """ニコニコ動画のシリーズをnvapiから取得する"""
+    api_url = f"https://nvapi.nicovideo.jp/v2/series/{series_id}"
+    try:
+        items = fetch_nvapi_items(api_url, lambda data: data['items'])
+        if items is not None:
+            return [nvapi_video_to_metadata(item['video']) for item in items]
     except Exception:
         pass
     return None
 
 def get_nico_mylist_metadata(mylist_url):
     """ニコニコ動画のマイリストRSSから動画一覧とマイリストコメントを取得する"""
-    match = re.search(r'mylist/(\d+)', mylist_url)
+    match = MYLIST_RE.search(mylist_url)
     if not match:
         return None
     mylist_id = match.group(1)
@@ -65,9 +302,10 @@ def get_nico_mylist_metadata(mylist_url):
     url = f"https://www.nicovideo.jp/mylist/{mylist_id}?rss=2.0"
     videos = []
     try:
-        response = requests.get(url, timeout=10)
+        response = SESSION.get(url, timeout=10)
         if response.status_code == 200:
-            root = ET.fromstring(response.text)
+            root = etree.fromstring(response.content)
+            items = []
             for item in root.findall('.//item'):
                 link = item.find('link').text
                 v_id = link.split('?')[0].split('/')[-1] if link else None
@@ -85,13 +323,16 @@ def get_nico_mylist_metadata(mylist_url):
                 else:
                     memo = ""
                 
-                # 詳細情報をAPIから取得
-                nico_data = get_nico_metadata_api(v_id)
+                title = item.find('title').text if item.find('title') is not None else "[タイトル取得不可]"
+                items.append((v_id, link, title, memo))
+
+            # 詳細情報をAPIからまとめて取得
+            nico_data_map = get_nico_metadata_batch([v_id for v_id, _, _, _ in items])
+            for v_id, link, title, memo in items:
+                nico_data = nico_data_map.get(v_id)
                 if nico_data:
-                    nico_data['mylist_comment'] = memo
-                    videos.append(nico_data)
+                    videos.append(dict(nico_data, mylist_comment=memo))
                 else:
-                    title = item.find('title').text if item.find('title') is not None else "[タイトル取得不可]"
                     videos.append({
                         'video_id': v_id,
                         'title': title,
@@ -101,7 +342,6 @@ def get_nico_mylist_metadata(mylist_url):
                         'mylist_comment': memo,
                         'url': link
                     })
-                time.sleep(0.05)
             return videos
     except Exception:
         pass
@@ -109,36 +349,85 @@ def get_nico_mylist_metadata(mylist_url):
 
 def extract_id_manually(url):
     """URLから強引にIDを抜き出す"""
-    nico = NICO_ID_RE.findall(url)
+    nico = NICO_ID_RE.search(url)
     if nico:
-        return nico[0], "Niconico"
-    yt = YT_ID_RE.findall(url)
+        return nico.group(1), "Niconico"
+    yt = YT_ID_RE.search(url)
     if yt:
-        return yt[0], "YouTube"
+        return yt.group(1), "YouTube"
     return None, None
 
-def extract_urls_from_text(text):
-    """自由記入欄などのテキストから複数のURLやIDを安全に抽出する"""
-    if pd.isna(text) or not str(text).strip() or str(text).lower() == 'nan':
-        return []
-    
-    text_str = str(text)
-    
-    urls = re.findall(r'https?://[^\s<>"]+', text_str)
-    nicos = NICO_ID_RE.findall(text_str)
-    
-    result = []
-    for url in urls:
-        if url not in result:
-            result.append(url)
-            
+def merge_urls_and_ids(urls, nico_ids):
+    """抽出したURLとIDをまとめる（URLに含まれていないIDは視聴ページのURLにする）"""
+    result = list(dict.fromkeys(urls))
+
     joined_urls = " ".join(result)
-    for n_id in nicos:
+    for n_id in nico_ids:
         if n_id not in joined_urls:
             result.append(f"https://www.nicovideo.jp/watch/{n_id}")
-            
+
     return result
 
+def extract_urls_from_column(texts):
+    """自由記入欄などの列全体から、行ごとに複数のURLやIDをまとめて抽出する"""
+    texts = pd.Series(texts, dtype=object)
+    url_lists = texts.str.findall(URL_RE)
+    id_lists = texts.str.findall(NICO_ID_RE)
+    return [merge_urls_and_ids(urls, ids) for urls, ids in zip(url_lists, id_lists)]
+
+def fetch_ytdlp_metadata(url_str):
+    """yt-dlp で情報を取得する（失敗時は例外を送出する。単体動画の結果だけを YTDLP_VIDEO_CACHE に保存する）"""
+    cached = YTDLP_VIDEO_CACHE.get(url_str)
+    if cached is not None:
+        return cached
+
+    # 1つのインスタンスを同時に複数スレッドで使わないよう、取り出して使い終わったら戻す
+    ydl = take_ydl()
+    try:
+        info = ydl.extract_info(url_str, download=False)
+    finally:
+        YDL_POOL.put(ydl)
+
+    if 'entries' in info:
+        videos = []
+        entries = [entry for entry in info['entries'] if entry]
+        # ニコニコ動画のエントリーはAPIからまとめて詳細を取得
+        nico_data_map = get_nico_metadata_batch([
+            entry['id'] for entry in entries
+            if entry.get('id') and entry['id'][:2] in NICO_ID_PREFIXES
+        ])
+        for entry in entries:
+            v_id = entry.get('id')
+            # yt-dlpからの概要欄はマイリストコメントとは違うため空にする
+            nico_data = nico_data_map.get(v_id)
+            if nico_data:
+                videos.append(dict(nico_data, mylist_comment=""))
+                continue
+            
+            videos.append({
+                'video_id': v_id or entry.get('url'),
+                'title': entry.get('title') or "[タイトル取得不可]",
+                'uploader': entry.get('uploader') or entry.get('channel') or "[投稿者不明]",
+                'upload_date': format_yt_date(entry.get('upload_date')),
+                'duration': format_duration(entry.get('duration')),
+                'mylist_comment': "",
+                'url': entry.get('url') or url_str
+            })
+        # 再生リストの中身は変わりうるため保存しない
+        return videos
+    else:
+        videos = [{
+            'video_id': info.get('id'),
+            'title': info.get('title') or "[タイトル取得不可]",
+            'uploader': info.get('uploader') or info.get('channel') or "[投稿者不明]",
+            'upload_date': format_yt_date(info.get('upload_date')),
+            'duration': format_duration(info.get('duration')),
+            'mylist_comment': "",
+            'url': url_str
+        }]
+        YTDLP_VIDEO_CACHE.put(url_str, videos)
+        return videos
+
 def get_video_metadata(url):
     """情報取得のメイン制御"""
     url_str = str(url).strip()
@@ -147,65 +436,34 @@ def get_video_metadata(url):
     if not url_str.startswith('http') and not NICO_ID_RE.search(url_str):
         return None
 
-    # ニコニコマイリストの場合はRSS解析処理へ（ここでマイリストコメントを取得）
-    if "nicovideo.jp/mylist/" in url_str:
-        mylist_data = get_nico_mylist_metadata(url_str)
-        if mylist_data is not None:
-            return mylist_data
+    # ニコニコマイリスト・シリーズは yt-dlp を通さず nvapi から直接取得
+    # （マイリストコメントもここで取得。nvapi が使えない場合はRSS解析処理へ）
+    if "nicovideo.jp" in url_str:
+        mylist_match = MYLIST_RE.search(url_str)
+        if mylist_match:
+            mylist_data = get_nico_mylist_nvapi(mylist_match.group(1))
+            if mylist_data is None:
+                mylist_data = get_nico_mylist_metadata(url_str)
+            if mylist_data is not None:
+                return mylist_data
+
+        series_match = SERIES_RE.search(url_str)
+        if series_match:
+            series_data = get_nico_series_nvapi(series_match.group(1))
+            if series_data is not None:
+                return series_data
 
     # ニコニコ単体動画の場合（マイリストコメントは存在しない）
-    nico_ids = NICO_ID_RE.findall(url_str)
-    if nico_ids and "mylist" not in url_str:
-        data = get_nico_metadata_api(nico_ids[0])
+    nico_match = NICO_ID_RE.search(url_str)
+    if nico_match and "mylist" not in url_str:
+        data = get_nico_metadata_api(nico_match.group(1))
         if data:
             data['mylist_comment'] = ""
             return [data]
 
     # YouTube等の場合は yt-dlp を使用
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'extract_flat': True,
-        'skip_download': True,
-    }
-    
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url_str, download=False)
-            
-            if 'entries' in info:
-                videos = []
-                for entry in info['entries']:
-                    if entry:
-                        v_id = entry.get('id')
-                        # yt-dlpからの概要欄はマイリストコメントとは違うため空にする
-                        if v_id and (v_id.startswith('sm') or v_id.startswith('so') or v_id.startswith('nm')):
-                            nico_data = get_nico_metadata_api(v_id)
-                            if nico_data:
-                                nico_data['mylist_comment'] = ""
-                                videos.append(nico_data)
-                                continue
-                        
-                        videos.append({
-                            'video_id': v_id or entry.get('url'),
-                            'title': entry.get('title') or "[タイトル取得不可]",
-                            'uploader': entry.get('uploader') or entry.get('channel') or "[投稿者不明]",
-                            'upload_date': format_yt_date(entry.get('upload_date')),
-                            'duration': format_duration(entry.get('duration')),
-                            'mylist_comment': "",
-                            'url': entry.get('url') or url_str
-                        })
-                return videos
-            else:
-                return [{
-                    'video_id': info.get('id'),
-                    'title': info.get('title') or "[タイトル取得不可]",
-                    'uploader': info.get('uploader') or info.get('channel') or "[投稿者不明]",
-                    'upload_date': format_yt_date(info.get('upload_date')),
-                    'duration': format_duration(info.get('duration')),
-                    'mylist_comment': "",
-                    'url': url_str
-                }]
+        return fetch_ytdlp_metadata(url_str)
     except Exception:
         v_id, platform = extract_id_manually(url_str)
         if v_id:
@@ -223,108 +481,159 @@ def get_video_metadata(url):
 def format_yt_date(date_str):
     if not date_str or not isinstance(date_str, str):
         return "[不明]"
+    # yt-dlp の日付は YYYYMMDD 形式なので、解析せずに切り出して整形する
+    if len(date_str) == 8 and date_str.isdigit():
+        return f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:]}"
+    return date_str
+
+def detect_csv_encoding(content):
+    """CSVの文字コードを判定する（UTF-8でなければ推定し、推定できなければShift-JIS）"""
     try:
-        if len(date_str) == 8:
-            dt = datetime.strptime(date_str, '%Y%m%d')
-            return dt.strftime('%Y-%m-%d')
-    except:
+        content.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
         pass
-    return date_str
+    best = from_bytes(content).best()
+    return best.encoding if best else 'shift-jis'
+
+def get_column_values(df, name, position, default):
+    """列名（なければ列の位置）で列を特定し、前後の空白を除いた文字列の配列として取り出す"""
+    if name in df.columns:
+        column = df[name]
+    elif len(df.columns) > position:
+        column = df.iloc[:, position]
+    else:
+        return np.full(len(df), default, dtype=object)
+    # 欠損値は空文字にそろえ、列全体をまとめて文字列化・空白除去する
+    return column.fillna("").astype(str).str.strip().to_numpy()
 
 def process_data(df):
-    all_votes = []
     video_meta_cache = {} 
-    respondent_counts = {} 
-    
+    row_urls = []
+
+    # 1. 各回答から処理対象のURLを集める（列は行ループの前にまとめて取り出す）
+    respondents = get_column_values(df, '回答者名', 1, "匿名")
+    mylist_urls = get_column_values(df, 'マイリストのURL', 4, "")
+    ext_texts = get_column_values(df, 'マイリストに含める事ができない動画を選出する場合', 5, "")
+    respondent_missing = respondents == ''
+    mylist_url_lists = extract_urls_from_column(mylist_urls)
+    ext_url_lists = extract_urls_from_column(ext_texts)
+
+    for i in range(len(df)):
+        respondent = f"匿名_{i+1}" if respondent_missing[i] else respondents[i]
+        urls_to_process = list(dict.fromkeys(mylist_url_lists[i] + ext_url_lists[i]))
+        row_urls.append((respondent, urls_to_process))
+
+    # 2. 重複を除いたURLの情報を並列で取得する
+    unique_urls = list(dict.fromkeys(url for _, urls in row_urls for url in urls))
+    total_urls = len(unique_urls)
+    if not unique_urls: return None, []
+
     progress_text = "動画解析中..."
     progress_bar = st.progress(0, text=progress_text)
-    total_rows = len(df)
+    # プログレスバーの更新はブラウザとの通信が発生するため、最大50回程度に間引く
+    progress_step = max(1, total_urls // PROGRESS_UPDATES)
 
-    for i, row in df.iterrows():
-        try:
-            if '回答者名' in df.columns:
-                respondent = str(row['回答者名'])
-            else:
-                respondent = str(row.iloc[1]) if len(row) > 1 else "匿名"
+    with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+        futures = {executor.submit(get_video_metadata, url): url for url in unique_urls}
+        for done, future in enumerate(as_completed(futures), start=1):
+            video_meta_cache[futures[future]] = future.result()
+            if done % progress_step == 0 or done == total_urls:
+                progress_bar.progress(done / total_urls, text=f"{progress_text} ({done}/{total_urls}件)")
 
-            if 'マイリストのURL' in df.columns:
-                mylist_url = str(row['マイリストのURL'])
-            else:
-                mylist_url = str(row.iloc[4]) if len(row) > 4 else ""
+    # 3. 回答者とURLの対応表に取得済みの動画情報を結合して投票データにする（通信なし）
+    answers_df = pd.DataFrame({
+        'respondent': [respondent for respondent, urls in row_urls for _ in urls],
+        'url': [url for _, urls in row_urls for url in urls]
+    })
+    meta_records = [
+        (url, v['video_id'], v['title'], v['uploader'], v['upload_date'],
+         v.get('duration', "[不明]"), v.get('mylist_comment', ""))
+        for url, results in video_meta_cache.items() if results
+        for v in results
+    ]
+    meta_df = pd.DataFrame.from_records(
+        meta_records,
+        columns=['url', 'video_id', 'title', 'uploader', 'upload_date', 'duration', 'comment']
+    )
+    votes_df = answers_df.merge(meta_df, on='url', how='inner')
 
-            if 'マイリストに含める事ができない動画を選出する場合' in df.columns:
-                ext_text = str(row['マイリストに含める事ができない動画を選出する場合'])
-            else:
-                ext_text = str(row.iloc[5]) if len(row) > 5 else ""
-                
-            if respondent == 'nan' or not respondent: respondent = f"匿名_{i+1}"
-        except Exception:
-            continue
-
-        if respondent not in respondent_counts:
-            respondent_counts[respondent] = 0
-
-        urls_to_process = []
-        urls_to_process.extend(extract_urls_from_text(mylist_url))
-        urls_to_process.extend(extract_urls_from_text(ext_text))
-        
-        urls_to_process = list(dict.fromkeys(urls_to_process))
-        
-        for url in urls_to_process:
-            if url in video_meta_cache:
-                results = video_meta_cache[url]
-            else:
-                results = get_video_metadata(url)
-                video_meta_cache[url] = results
-                time.sleep(0.05) 
-
-            if results:
-                for v in results:
-                    all_votes.append({
-                        'video_id': v['video_id'],
-                        'title': v['title'],
-                        'uploader': v['uploader'],
-                        'upload_date': v['upload_date'],
-                        'duration': v.get('duration', "[不明]"),
-                        'comment': v.get('mylist_comment', ""),
-                        'respondent': respondent
-                    })
-                    respondent_counts[respondent] += 1
+    if votes_df.empty: return None, []
 
-        progress_bar.progress((i + 1) / total_rows, text=f"{progress_text} ({i+1}/{total_rows}行目)")
+    # 集計キーの動画IDはカテゴリ型にして、文字列のハッシュ計算を整数コードの比較で済ませる
+    # （選出者は list で集計するため文字列のまま。カテゴリ型だと pandas 3 で list 集計が失敗する）
+    votes_df['video_id'] = votes_df['video_id'].astype('category')
 
-    if not all_votes: return None, []
+    # 選出数は投票データから一括で数える（1票もない回答者も0票として扱う）
+    respondent_counts = votes_df.groupby('respondent', sort=False).size()
+    invalid_respondents = [
+        name for name in dict.fromkeys(respondent for respondent, _ in row_urls)
+        if respondent_counts.get(name, 0) != 10
+    ]
 
-    invalid_respondents = [name for name, count in respondent_counts.items() if count != 10]
-    votes_df = pd.DataFrame(all_votes)
+    # マイリストコメントは空欄と重複を除き、動画ごとに出現順でつなげる
+    comments = (
+        votes_df.loc[votes_df['comment'].notna() & (votes_df['comment'] != ""), ['video_id', 'comment']]
+        .drop_duplicates()
+        .groupby('video_id', sort=False, observed=True)['comment']
+        .agg(" / ".join)
+    )
+    comments.index = comments.index.astype(str)
 
-    ranking = votes_df.groupby('video_id').agg({
-        'title': 'first',
-        'upload_date': 'first',
-        'uploader': 'first',
-        'duration': 'first',
-        'respondent': lambda x: sorted(list(set(x))),
-        'comment': lambda x: " / ".join(filter(None, set(x))) 
-    }).reset_index()
+    # 同じ人の同じ動画への重複票を除き、選出者順に並べておくことで
+    # list 集計だけで並び替え済みの選出者リストが得られる
+    # （動画の並びは最後に得票数・動画IDで決めるため、ここでは動画IDで並べない）
+    votes_df = votes_df.drop_duplicates(subset=['video_id', 'respondent'])
+    votes_df = votes_df.sort_values('respondent', kind='stable')
+
+    ranking = votes_df.groupby('video_id', sort=False, observed=True).agg(
+        title=('title', 'first'),
+        upload_date=('upload_date', 'first'),
+        uploader=('uploader', 'first'),
+        duration=('duration', 'first'),
+        respondent=('respondent', list),
+        得票数=('respondent', 'size')
+    ).reset_index()
+    ranking['video_id'] = ranking['video_id'].astype(str)
+    ranking['comment'] = ranking['video_id'].map(comments).fillna("")
 
-    ranking['得票数'] = ranking['respondent'].apply(len)
     ranking = ranking.sort_values(by=['得票数', 'video_id'], ascending=[False, True])
-    ranking['順位(被りなし)'] = range(1, len(ranking) + 1)
-    ranking['順位(被りあり)'] = ranking['得票数'].rank(ascending=False, method='min').astype(int)
+    positions = np.arange(1, len(ranking) + 1)
+    ranking['順位(被りなし)'] = positions
+    # 得票数の降順に並んでいるので、得票数が変わる位置の順位を同票の間で引き継ぐ（method='min' 相当）
+    counts = ranking['得票数'].to_numpy()
+    is_new_count = np.r_[True, counts[1:] != counts[:-1]]
+    ranking['順位(被りあり)'] = np.maximum.accumulate(np.where(is_new_count, positions, 0))
     
     return ranking, invalid_respondents
 
+def to_csv_bytes(df):
+    """DataFrame を Excel でも読めるCSV（UTF-8/BOM付き）のバイト列にする"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    buf = pa.BufferOutputStream()
+    pa.csv.write_csv(table, buf)
+    return b'\xef\xbb\xbf' + buf.getvalue().to_pybytes()
+
 # --- UI ---
 st.title("📊 動画選出集計・ランキングツール")
 
 uploaded_file = st.file_uploader("回答CSVをアップロード", type=['csv'])
 
+if st.button("🗑️ 取得済みの動画情報を削除"):
+    st.cache_data.clear()
+    YTDLP_VIDEO_CACHE.clear()
+    SESSION.cache.clear()
+    st.info("キャッシュを削除しました。次回の集計では動画情報を取得し直します。")
+
 if uploaded_file:
-    content = uploaded_file.read()
-    try:
-        df_input = pd.read_csv(io.BytesIO(content), encoding='utf-8')
-    except:
-        df_input = pd.read_csv(io.BytesIO(content), encoding='shift-jis')
+    # UploadedFile はメモリ上のファイルなので、判定用にバイト列を参照しつつ
+    # 読み込みはそのまま渡す（BytesIO で包み直さない）
+    content = uploaded_file.getvalue()
+    # 全列を文字列のまま読み込む（型推論・欠損値判定を省き、空欄は空文字になる）
+    csv_options = {'dtype': str, 'na_filter': False, 'engine': 'c'}
+    encoding = detect_csv_encoding(content)
+    uploaded_file.seek(0)
+    df_input = pd.read_csv(uploaded_file, encoding=encoding, **csv_options)
 
     st.write(f"📋 読込成功: {len(df_input)} 行の回答")
 
@@ -338,7 +647,7 @@ if uploaded_file:
                     st.warning(f"⚠️ 10作品ではない方: {', '.join(invalid_respondents)}")
 
                 final_output = result_df.copy()
-                final_output['選出者一覧'] = final_output['respondent'].apply(lambda x: ", ".join(x))
+                final_output['選出者一覧'] = final_output['respondent'].str.join(", ")
                 
                 final_output = final_output[[
                     '順位(被りあり)', '得票数', 'title', 'duration', 'video_id', 'upload_date', 'uploader', '選出者一覧', 'comment'
@@ -356,7 +665,7 @@ if uploaded_file:
                 st.subheader("🏆 動画ランキング")
                 st.dataframe(final_output, use_container_width=True)
                 
-                csv_data = final_output.to_csv(index=False, encoding='utf-8-sig')
+                csv_data = to_csv_bytes(final_output)
                 st.download_button(
                     label="📥 CSVをダウンロード",
                     data=csv_data,